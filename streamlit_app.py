@@ -5,6 +5,8 @@ import plotly.express as px
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 import numpy as np
+import io
+from concurrent.futures import ThreadPoolExecutor
 
 # Configurazione della pagina
 st.set_page_config(
@@ -13,99 +15,130 @@ st.set_page_config(
     layout="wide"
 )
 
-def clean_percentage(value):
-    """Converte una stringa con percentuale europea (con virgola) in float"""
-    if pd.isna(value) or value == '':
-        return 0.0
-    clean_val = str(value).strip().replace(',', '.')
-    try:
-        return float(clean_val)
-    except:
-        return 0.0
-
-def load_and_clean_data(uploaded_file):
-    """Carica e pulisce i dati da un file CSV"""
+# Colonne dei file CSV iShares utilizzate dall'analisi
+CSV_COLUMNS = ["Ticker dell'emittente", 'Nome', 'Asset Class', 'Settore', 'Area Geografica', 'Ponderazione (%)']
+CSV_DTYPES = {'Asset Class': 'category', 'Settore': 'category', 'Area Geografica': 'category'}
+
+# Colonne delle holding pulite restituite da load_and_clean_data
+HOLDINGS_COLUMNS = ["Ticker dell'emittente", 'Nome', 'Settore', 'Area Geografica', 'Ponderazione']
+HOLDINGS_DTYPES = {'Settore': 'category', 'Area Geografica': 'category'}
+
+# Oltre questa dimensione i file vengono letti a blocchi di CSV_CHUNK_SIZE righe
+LARGE_CSV_BYTES = 20 * 1024 * 1024
+CSV_CHUNK_SIZE = 100_000
+
+def clean_percentage(values):
+    """Converte una Series di percentuali europee (con virgola) in float"""
+    clean_values = values.astype('string').str.strip().str.replace(',', '.', regex=False)
+    return pd.to_numeric(clean_values, errors='coerce').fillna(0.0)
+
+def read_holdings_csv(file_bytes):
+    """Legge il CSV in blocchi di DataFrame: un unico blocco per i file normali, più blocchi per quelli grandi"""
+    if len(file_bytes) > LARGE_CSV_BYTES:
+        # File grandi: lettura a blocchi per limitare la memoria
+        return pd.read_csv(io.BytesIO(file_bytes), skiprows=2, usecols=CSV_COLUMNS, dtype=CSV_DTYPES,
+                           engine='c', chunksize=CSV_CHUNK_SIZE)
+    return [pd.read_csv(io.BytesIO(file_bytes), skiprows=2, usecols=CSV_COLUMNS, dtype=CSV_DTYPES, engine='c')]
+
+@st.cache_data(show_spinner=False)
+def load_and_clean_data(file_bytes):
+    """Carica e pulisce i dati da un file CSV (contenuto in bytes), restituisce (df, errore)"""
     try:
+        chunks = []
         # Legge il file saltando le prime 2 righe (metadata)
-        df = pd.read_csv(uploaded_file, skiprows=2)
-
-        # Pulisce la colonna delle ponderazioni
-        df['Ponderazione'] = df['Ponderazione (%)'].apply(clean_percentage)
-
-        # Filtra solo le holding azionarie e con ponderazione > 0
-        df = df[(df['Asset Class'] == 'Azionario') & (df['Ponderazione'] > 0)]
-
-        return df
+        for chunk in read_holdings_csv(file_bytes):
+            # Pulisce la colonna delle ponderazioni
+            chunk['Ponderazione'] = clean_percentage(chunk['Ponderazione (%)'])
+
+            # Filtra solo le holding azionarie e con ponderazione > 0, tenendo le colonne usate nell'analisi
+            chunk = chunk[(chunk['Asset Class'] == 'Azionario') & (chunk['Ponderazione'] > 0)]
+            chunks.append(chunk[HOLDINGS_COLUMNS])
+
+        if len(chunks) == 1:
+            return chunks[0], None
+        # Blocchi con categorie diverse vengono uniti come object: si ripristinano le categorie
+        return pd.concat(chunks, ignore_index=True).astype(HOLDINGS_DTYPES), None
     except Exception as e:
-        st.error(f"Errore nel caricamento del file: {str(e)}")
-        return None
-
-def aggregate_portfolio_data(etf_files, weights):
-    """Aggrega i dati del portafoglio basato sui pesi degli ETF"""
-    portfolio_holdings = {}
-    portfolio_sectors = {}
-    portfolio_regions = {}
-
-    for i, (etf_file, weight) in enumerate(zip(etf_files, weights)):
-        df = load_and_clean_data(etf_file)
-        if df is not None:
-            # Aggrega holding
-            for _, row in df.iterrows():
-                ticker = row["Ticker dell'emittente"]
-                name = row['Nome']
-                contribution = row['Ponderazione'] * weight / 100
-
-                if ticker in portfolio_holdings:
-                    portfolio_holdings[ticker]['weight'] += contribution
-                else:
-                    portfolio_holdings[ticker] = {
-                        'name': name,
-                        'weight': contribution,
-                        'sector': row['Settore'],
-                        'region': row['Area Geografica']
-                    }
-
-            # Aggrega settori
-            sector_weights = df.groupby('Settore')['Ponderazione'].sum()
-            for sector, sector_weight in sector_weights.items():
-                contribution = sector_weight * weight / 100
-                portfolio_sectors[sector] = portfolio_sectors.get(sector, 0) + contribution
-
-            # Aggrega regioni
-            region_weights = df.groupby('Area Geografica')['Ponderazione'].sum()
-            for region, region_weight in region_weights.items():
-                contribution = region_weight * weight / 100
-                portfolio_regions[region] = portfolio_regions.get(region, 0) + contribution
+        # L'errore viene mostrato dal chiamante: qui si può essere in un thread senza contesto Streamlit
+        return None, f"Errore nel caricamento del file: {str(e)}"
+
+def sum_by(keys, weights):
+    """Somma i pesi per chiave con factorize + bincount (chiavi mancanti escluse)"""
+    codes, uniques = pd.factorize(keys, sort=False)
+    valid = codes >= 0
+    sums = np.bincount(codes[valid], weights=weights.to_numpy(dtype=np.float64)[valid], minlength=len(uniques))
+    return pd.Series(sums, index=pd.Index(uniques, name=keys.name), name=weights.name)
+
+def load_portfolio_data(etf_bytes):
+    """Carica gli ETF del portafoglio in un unico DataFrame (colonna ETF = indice del file) e la lista degli errori"""
+    # Carica gli ETF in parallelo (il parser C di read_csv rilascia il GIL)
+    if len(etf_bytes) > 1:
+        with ThreadPoolExecutor(max_workers=len(etf_bytes)) as executor:
+            loaded = list(executor.map(load_and_clean_data, etf_bytes))
+    else:
+        loaded = [load_and_clean_data(data) for data in etf_bytes]
+
+    dfs = [df.assign(ETF=i) for i, (df, _) in enumerate(loaded) if df is not None]
+    errors = [error for _, error in loaded if error is not None]
+    if not dfs:
+        return None, errors
+    return pd.concat(dfs, ignore_index=True), errors
+
+def aggregate_portfolio_data(all_df, weights):
+    """Aggrega i dati del portafoglio basato sui pesi degli ETF in DataFrame/Series"""
+    if all_df is None:
+        empty = pd.Series(dtype='float64')
+        return pd.DataFrame(columns=['name', 'weight', 'sector', 'region']), empty, empty
+
+    # Contributo di ogni holding al portafoglio (unico passaggio che dipende dai pesi)
+    etf_weights = np.asarray(weights, dtype=np.float64)[all_df['ETF'].to_numpy()]
+    contributions = pd.Series(all_df['Ponderazione'].to_numpy(dtype=np.float64) * etf_weights / 100,
+                              index=all_df.index, name='Ponderazione')
+
+    # Aggrega holding: codici interi per ticker e somma pesata con bincount
+    codes, tickers = pd.factorize(all_df["Ticker dell'emittente"], sort=False, use_na_sentinel=False)
+    holding_weights = np.bincount(codes, weights=contributions.to_numpy())
+    _, first = np.unique(codes, return_index=True)
+    portfolio_holdings = pd.DataFrame({
+        'name': all_df['Nome'].to_numpy()[first],
+        'weight': holding_weights,
+        'sector': all_df['Settore'].to_numpy()[first],
+        'region': all_df['Area Geografica'].to_numpy()[first]
+    }, index=pd.Index(tickers, name="Ticker dell'emittente"))
+
+    # Aggrega settori e regioni
+    portfolio_sectors = sum_by(all_df['Settore'], contributions)
+    portfolio_regions = sum_by(all_df['Area Geografica'], contributions)
 
     return portfolio_holdings, portfolio_sectors, portfolio_regions
 
-def create_top_holdings_chart(benchmark_df, portfolio_holdings):
-    """Crea il grafico delle top 30 holding"""
-    # Top 30 holding del benchmark
-    top_30_benchmark = benchmark_df.nlargest(30, 'Ponderazione')
+@st.cache_data(show_spinner=False)
+def aggregate_benchmark_data(file_bytes, top_n):
+    """Calcola una sola volta top N holding, settori e regioni del benchmark"""
+    benchmark_df, _ = load_and_clean_data(file_bytes)
+    if benchmark_df is None:
+        return None
 
-    # Estrae i pesi del portafoglio per le stesse holding
-    portfolio_weights = []
-    holding_names = []
+    top_benchmark = benchmark_df.nlargest(top_n, 'Ponderazione')
+    benchmark_sectors = sum_by(benchmark_df['Settore'], benchmark_df['Ponderazione'])
+    benchmark_regions = sum_by(benchmark_df['Area Geografica'], benchmark_df['Ponderazione'])
 
-    for _, row in top_30_benchmark.iterrows():
-        ticker = row["Ticker dell'emittente"]
-        name = row['Nome']
-        holding_names.append(name)
+    return top_benchmark, benchmark_sectors, benchmark_regions
 
-        if ticker in portfolio_holdings:
-            portfolio_weights.append(portfolio_holdings[ticker]['weight'])
-        else:
-            portfolio_weights.append(0)
+def create_top_holdings_chart(top_benchmark, portfolio_holdings):
+    """Crea il grafico delle top N holding del benchmark"""
+    # Estrae i pesi del portafoglio per le stesse holding
+    portfolio_weights = top_benchmark["Ticker dell'emittente"].map(portfolio_holdings['weight']).fillna(0).to_numpy(dtype=np.float64)
+    holding_names = top_benchmark['Nome'].tolist()
 
-    # Crea il grafico
+    # Crea il grafico (array float64 serializzati da Plotly come typed array)
     fig = go.Figure(data=[
-        go.Bar(name='Benchmark', x=holding_names, y=top_30_benchmark['Ponderazione'].tolist()),
+        go.Bar(name='Benchmark', x=holding_names, y=top_benchmark['Ponderazione'].to_numpy(dtype=np.float64)),
         go.Bar(name='Portfolio', x=holding_names, y=portfolio_weights)
     ])
 
     fig.update_layout(
-        title='Top 30 Holdings: Benchmark vs Portfolio',
+        title=f'Top {len(top_benchmark)} Holdings: Benchmark vs Portfolio',
         xaxis_title='Holdings',
         yaxis_title='Weight (%)',
         barmode='group',
@@ -115,21 +148,16 @@ def create_top_holdings_chart(benchmark_df, portfolio_holdings):
 
     return fig
 
-def create_sector_comparison_chart(benchmark_df, portfolio_sectors):
+def create_sector_comparison_chart(benchmark_sectors, portfolio_sectors):
     """Crea il grafico di confronto settoriale"""
-    # Aggregazione settoriale del benchmark
-    benchmark_sectors = benchmark_df.groupby('Settore')['Ponderazione'].sum().to_dict()
-
-    # Unisce tutti i settori
-    all_sectors = set(benchmark_sectors.keys()) | set(portfolio_sectors.keys())
-
-    sectors = list(all_sectors)
-    benchmark_weights = [benchmark_sectors.get(sector, 0) for sector in sectors]
-    portfolio_weights = [portfolio_sectors.get(sector, 0) for sector in sectors]
+    # Unisce tutti i settori (ordine del benchmark, poi quelli solo in portafoglio)
+    sectors = benchmark_sectors.index.union(portfolio_sectors.index, sort=False)
+    benchmark_weights = benchmark_sectors.reindex(sectors, fill_value=0)
+    portfolio_weights = portfolio_sectors.reindex(sectors, fill_value=0)
 
     fig = go.Figure(data=[
-        go.Bar(name='Benchmark', x=sectors, y=benchmark_weights),
-        go.Bar(name='Portfolio', x=sectors, y=portfolio_weights)
+        go.Bar(name='Benchmark', x=sectors, y=benchmark_weights.to_numpy(dtype=np.float64)),
+        go.Bar(name='Portfolio', x=sectors, y=portfolio_weights.to_numpy(dtype=np.float64))
     ])
 
     fig.update_layout(
@@ -143,21 +171,16 @@ def create_sector_comparison_chart(benchmark_df, portfolio_sectors):
 
     return fig
 
-def create_region_comparison_chart(benchmark_df, portfolio_regions):
+def create_region_comparison_chart(benchmark_regions, portfolio_regions):
     """Crea il grafico di confronto geografico"""
-    # Aggregazione geografica del benchmark
-    benchmark_regions = benchmark_df.groupby('Area Geografica')['Ponderazione'].sum().to_dict()
-
-    # Unisce tutte le regioni
-    all_regions = set(benchmark_regions.keys()) | set(portfolio_regions.keys())
-
-    regions = list(all_regions)
-    benchmark_weights = [benchmark_regions.get(region, 0) for region in regions]
-    portfolio_weights = [portfolio_regions.get(region, 0) for region in regions]
+    # Unisce tutte le regioni (ordine del benchmark, poi quelle solo in portafoglio)
+    regions = benchmark_regions.index.union(portfolio_regions.index, sort=False)
+    benchmark_weights = benchmark_regions.reindex(regions, fill_value=0)
+    portfolio_weights = portfolio_regions.reindex(regions, fill_value=0)
 
     fig = go.Figure(data=[
-        go.Bar(name='Benchmark', x=regions, y=benchmark_weights),
-        go.Bar(name='Portfolio', x=regions, y=portfolio_weights)
+        go.Bar(name='Benchmark', x=regions, y=benchmark_weights.to_numpy(dtype=np.float64)),
+        go.Bar(name='Portfolio', x=regions, y=portfolio_weights.to_numpy(dtype=np.float64))
     ])
 
     fig.update_layout(
@@ -175,6 +198,9 @@ def create_region_comparison_chart(benchmark_df, portfolio_regions):
 st.title("Equity Composition Analyser for ETF Portfolios")
 st.markdown("---")
 
+# Numero di holding del benchmark da confrontare
+top_n = st.sidebar.slider("Top holdings", min_value=10, max_value=50, value=30, step=1)
+
 # Sezione upload benchmark
 st.header("1. Upload Benchmark ETF")
 benchmark_file = st.file_uploader(
@@ -184,9 +210,24 @@ benchmark_file = st.file_uploader(
 )
 
 if benchmark_file is not None:
-    benchmark_df = load_and_clean_data(benchmark_file)
+    # Ricarica il benchmark solo se il file è cambiato, riaggrega solo se cambiano file o top N
+    benchmark_bytes = benchmark_file.getvalue()
+    benchmark_key = hash(benchmark_bytes)
+    if st.session_state.get('benchmark_key') != benchmark_key:
+        st.session_state['benchmark_df'], st.session_state['benchmark_error'] = load_and_clean_data(benchmark_bytes)
+        st.session_state['benchmark_key'] = benchmark_key
+    benchmark_df = st.session_state['benchmark_df']
+
+    # L'errore è conservato in session_state e mostrato a ogni rerun
+    if st.session_state['benchmark_error']:
+        st.error(st.session_state['benchmark_error'])
 
     if benchmark_df is not None:
+        benchmark_data_key = (benchmark_key, top_n)
+        if st.session_state.get('benchmark_data_key') != benchmark_data_key:
+            st.session_state['benchmark_data'] = aggregate_benchmark_data(benchmark_bytes, top_n)
+            st.session_state['benchmark_data_key'] = benchmark_data_key
+        top_benchmark, benchmark_sectors, benchmark_regions = st.session_state['benchmark_data']
         st.success(f"Benchmark: {len(benchmark_df)} holdings")
 
         # Sezione upload portafoglio
@@ -231,19 +272,34 @@ if benchmark_file is not None:
 
         # Verifica che i pesi sommino a 100%
         total_weight = sum(weights)
-        if abs(total_weight - 100.0) > 0.01:
+        weights_valid = abs(total_weight - 100.0) <= 0.01
+        if not weights_valid:
             st.warning(f"Allocation does not sum to 100% (current: {total_weight:.1f}%)")
         else:
             st.success(f"Allocation: {total_weight:.1f}%")
 
-        # Analisi e grafici
-        if all(etf_file is not None for etf_file in etf_files):
+        # Analisi e grafici (solo con allocazione valida)
+        if weights_valid and all(etf_file is not None for etf_file in etf_files):
             st.header("3. Exposure analysis")
 
-            with st.spinner("Loading..."):
-                portfolio_holdings, portfolio_sectors, portfolio_regions = aggregate_portfolio_data(etf_files, weights)
-
-            if portfolio_holdings:
+            # Ricarica gli ETF solo se i file sono cambiati, riaggrega solo se cambiano file o pesi
+            etf_bytes = tuple(etf_file.getvalue() for etf_file in etf_files)
+            etf_key = tuple(hash(data) for data in etf_bytes)
+            portfolio_key = (etf_key, tuple(weights))
+            if st.session_state.get('portfolio_key') != portfolio_key:
+                with st.spinner("Loading..."):
+                    if st.session_state.get('etf_key') != etf_key:
+                        st.session_state['etf_df'], st.session_state['etf_errors'] = load_portfolio_data(etf_bytes)
+                        st.session_state['etf_key'] = etf_key
+                    st.session_state['portfolio_data'] = aggregate_portfolio_data(st.session_state['etf_df'], weights)
+                st.session_state['portfolio_key'] = portfolio_key
+
+            # Errori raccolti dai thread di caricamento, mostrati dal thread principale a ogni rerun
+            for etf_error in st.session_state['etf_errors']:
+                st.error(etf_error)
+            portfolio_holdings, portfolio_sectors, portfolio_regions = st.session_state['portfolio_data']
+
+            if not portfolio_holdings.empty:
 
                 # Numero di holdings
                 st.subheader("Holdings")
@@ -260,19 +316,19 @@ if benchmark_file is not None:
                         len(portfolio_holdings)
                     )
 
-                # Grafico Top 30 Holdings
-                st.subheader("Top 30 Holdings")
-                fig_holdings = create_top_holdings_chart(benchmark_df, portfolio_holdings)
+                # Grafico Top N Holdings
+                st.subheader(f"Top {len(top_benchmark)} Holdings")
+                fig_holdings = create_top_holdings_chart(top_benchmark, portfolio_holdings)
                 st.plotly_chart(fig_holdings, use_container_width=True)
 
                 # Grafico Settoriale
                 st.subheader("Sector exposure")
-                fig_sectors = create_sector_comparison_chart(benchmark_df, portfolio_sectors)
+                fig_sectors = create_sector_comparison_chart(benchmark_sectors, portfolio_sectors)
                 st.plotly_chart(fig_sectors, use_container_width=True)
 
                 # Grafico Geografico
                 st.subheader("Geographical exposure")
-                fig_regions = create_region_comparison_chart(benchmark_df, portfolio_regions)
+                fig_regions = create_region_comparison_chart(benchmark_regions, portfolio_regions)
                 st.plotly_chart(fig_regions, use_container_width=True)
   
 else: